@@ -6,206 +6,443 @@ This script is meant to run on an ESXi host
 
 '''
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from threading import BoundedSemaphore
+import asyncio
+import json
 from pprint import pprint
-from time import sleep
+from time import sleep, monotonic, time
+import subprocess
 import sys
 import os
+import re
 
+# ---------------------------------------------------------------- CONFIGURATION SECTION
 
-vms_template = '''
-Vmid            Name                                              File                                             Guest OS          Version {{ignore}}                                Annotation
-{{vmid}}   {{name}}                [EL_MGMT_VSAN] {{file}}               {{guestos}}       vmx-{{version}}
-'''
+# Upper bound on vim-cmd processes run side by side when working through the VM list
+MAX_WORKERS = 32
 
+# Upper bound on VM power on/off/shutdown requests in flight at once, whatever MAX_WORKERS is set to.
+# hostd accepts roughly 60 concurrent power-ons and 600 active tasks (1400 queued) per host; past that
+# it queues the requests itself and the parallel fan-out gains nothing. Keep this below 60.
+POWER_OP_CONCURRENCY = 32
 
-def getvms(host):
-    print("Parsing VMs...")
-    resp = host.send_command("vim-cmd vmsvc/getallvms | tail -n+2 | awk '{print $1\":\"$2}'")
-    print("Response is: " + resp)
+# Seconds to wait for the host to enter or leave maintenance mode before giving up
+MAINTENANCE_MODE_TIMEOUT = 45
 
-    if resp == '':
-        vms = ''
-        return vms
+# Seconds all VMs together get to finish a guest OS shutdown before they are powered off
+SHUTDOWN_TIMEOUT = 60
+
+# Status polls start at POLL_INITIAL_DELAY seconds apart and double up to POLL_MAX_DELAY.
+# Lower values notice state changes sooner at the cost of more esxcli/vim-cmd runs.
+POLL_INITIAL_DELAY = 0.5
+POLL_MAX_DELAY = 4.0
+
+# The VM inventory and the VMs this run powered off are saved here while VMs are down. If a run is
+# interrupted before it powers them back on, a re-run within STATE_MAX_AGE seconds takes over the
+# ones that are still off. The file is removed once the VMs are restored or the upgrade went through.
+# /tmp is a ramdisk on ESXi, so the file does not survive the reboot at the end of the upgrade.
+STATE_FILE = '/tmp/esxi_upgrade_state.json'
+STATE_MAX_AGE = 3600
+
+# ---------------------------------------------------------------- END CONFIGURATION SECTION
+
+# With --dry-run no command is executed, each one is printed and answered with a canned reply
+DRY_RUN = "--dry-run" in sys.argv
+
+_POWER_SEM = BoundedSemaphore(POWER_OP_CONCURRENCY)
+
+# Fixed leading argv of the commands run per VM or per poll
+_CMD_GETALLVMS = ("vim-cmd", "vmsvc/getallvms")
+_CMD_SUMMARY = ("vim-cmd", "vmsvc/get.summary")
+_CMD_POWER_ON = ("vim-cmd", "vmsvc/power.on")
+_CMD_POWER_OFF = ("vim-cmd", "vmsvc/power.off")
+_CMD_SHUTDOWN = ("vim-cmd", "vmsvc/power.shutdown")
+_CMD_AUTOSTART_ENTRY = ("vim-cmd", "hostsvc/autostartmanager/update_autostartentry")
+_CMD_HOSTSUMMARY = ("vim-cmd", "hostsvc/hostsummary")
+_CMD_MM_GET = ("esxcli", "system", "maintenanceMode", "get")
+_CMD_MM_SET = ("esxcli", "system", "maintenanceMode", "set")
+
+# vmid column of vim-cmd vmsvc/getallvms rows
+_VMID_RE = re.compile(r'^(\d+)\s', re.M)
+
+# Fields read out of vim-cmd vmsvc/get.summary output
+_POWER_RE = re.compile(r'powerState\s*=\s*"([^"]+)"')
+_TOOLS_RE = re.compile(r'toolsStatus\s*=\s*"([^"]+)"')
+
+# Field read out of vim-cmd hostsvc/hostsummary output
+_MM_RE = re.compile(r'inMaintenanceMode\s*=\s*(true|false)')
+
+# esxcli failures start with the exception name, e.g. [DependencyError] or [InstallationError]
+_ESXCLI_ERROR_RE = re.compile(r'^\s*(\[\w*Error\]|Error:)')
 
-    else:
-        vms = {}
-        for i in resp.split('\n'):
-            host = i.split(':')[1]
-            vmid = i.split(':')[0]
-            try:
-                int(vmid)
-                vms[host] = vmid
-            except:
-                pass
-    return vms
 
-def getvms_onbox():
+def _gated(semaphore):
+    # Runs the decorated function only while holding a slot of semaphore
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with semaphore:
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def getvms_onbox(resp=None):
+    # resp is vim-cmd vmsvc/getallvms output the caller already fetched, it is queried here otherwise
     print("Parsing VMs...")
-    resp = os.popen("vim-cmd vmsvc/getallvms | tail -n+2 | awk '{print $1\":\"$2}'").read()
-    print("Response is: " + resp)
+    if resp is None:
+        resp = sendcommand_onbox(list(_CMD_GETALLVMS))
+    print(f"Response is: {resp}")
+
+    # Only VM rows start with the numeric vmid, the header row and wrapped annotations are skipped
+    vmids = _VMID_RE.findall(resp)
 
-    if resp == '':
+    if not vmids:
         vms = ''
         return vms
 
-    else:
-        vms = {}
-        for i in resp.split('\n'):
-            host = i.split(':')[0]
-            vmid = i.split(':')[0]
-            try:
-                int(vmid)
-                vms[host] = vmid
-            except:
-                pass
+    # One get.summary per VM, all queried at once, gives both the power and the tools state
+    statuses = asyncio.run(gathervmstatus_onbox(vmids))
+    # Results arrive in completion order, keep the getallvms order for the auto-start sequence
+    vms = {vm: statuses[vm] for vm in vmids}
     return vms
 
+@_gated(_POWER_SEM)
+def sendshutdown_onbox(vm):
+    # Asks the guest OS to shut down through VMware tools and returns without waiting for it
+    resp = sendcommand_onbox([*_CMD_SHUTDOWN, vm])
+    print(f'Sent shutdown to VM {vm}')
+    return resp
+
+def waitpoweredoff_onbox(vm, deadline):
+    # Returns True if the VM reached poweredOff before the shared deadline
+    return waituntil(lambda: getvmpowerstate_onbox(vm) == "poweredOff", deadline - monotonic())
+
+@_gated(_POWER_SEM)
 def poweroffvm_onbox(vm):
-    # unlike function shutdownvm(), this will power off VMs regardless of having VMware tools installed
-    resp = os.popen('vim-cmd vmsvc/power.off ' + vm).read()
-    print('Powered down VM ' + vm)
+    # unlike sendshutdown_onbox(), this will power off VMs regardless of having VMware tools installed
+    resp = sendcommand_onbox([*_CMD_POWER_OFF, vm])
+    print(f'Powered down VM {vm}')
     return resp
 
 def getvmpowerstate_onbox(vm):
-    resp = os.popen("vim-cmd vmsvc/get.summary " + vm).read()
-    for i in resp.split('\n'):
-        if "powerState" in i:
-            return str(i.split("=")[1]).replace('"', '').replace(',', '').strip()
+    match = _POWER_RE.search(sendcommand_onbox([*_CMD_SUMMARY, vm]))
+    return match.group(1) if match else None
+
+def parsevmstatus(resp):
+    # Power and tools state out of one vim-cmd vmsvc/get.summary output
+    power = _POWER_RE.search(resp)
+    tools = _TOOLS_RE.search(resp)
+    return {"power": power.group(1) if power else None, "tools": tools.group(1) if tools else None}
+
+async def sendcommand_async_onbox(command, limit):
+    if DRY_RUN:
+        return dryrunresponse(command)
+    async with limit:
+        proc = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.STDOUT)
+        out, _ = await proc.communicate()
+    return out.decode()
+
+async def getvmsummary_async_onbox(vm, limit):
+    return vm, await sendcommand_async_onbox([*_CMD_SUMMARY, vm], limit)
+
+async def gathervmstatus_onbox(vmids):
+    # Every get.summary is started up front and handled as soon as it completes,
+    # so the wait is as long as the slowest VM rather than the sum of all of them
+    limit = asyncio.Semaphore(MAX_WORKERS)
+    statuses = {}
+    for future in asyncio.as_completed([getvmsummary_async_onbox(vm, limit) for vm in vmids]):
+        vm, resp = await future
+        statuses[vm] = parsevmstatus(resp)
+    return statuses
 
 def upgradehost_onbox(path):
+    # Output is printed line by line as esxcli produces it, the update can run for several minutes.
+    # Returns True only if esxcli reported success and printed no error.
     print("sending upgrade command to host.")
-    print("esxcli software profile update -p ESXi-7.0U2c-18426014-standard -d '" + path + "'")
-    resp = os.popen("esxcli software profile update -p ESXi-7.0U2c-18426014-standard -d '" + path + "'").read()
-    print(resp)
+    command = ["esxcli", "software", "profile", "update", "-p", "ESXi-7.0U2c-18426014-standard", "-d", path]
+    if DRY_RUN:
+        dryrunresponse(command)
+        return True
+    print(" ".join(command))
+    success = False
+    error = False
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, bufsize=1)
+    for line in proc.stdout:
+        print(line, end="")
+        if "completed successfully" in line:
+            success = True
+        if _ESXCLI_ERROR_RE.match(line):
+            if not error:
+                print("esxcli reported an error, the upgrade will be treated as failed.")
+            error = True
+    proc.wait()
+    return success and not error and proc.returncode == 0
+
+def waituntil(check, timeout):
+    # Calls check() with exponential backoff between tries, returns False if timeout runs out first
+    if DRY_RUN:
+        # Nothing was changed on the host, so there is no state to wait for
+        return True
+    deadline = monotonic() + timeout
+    delay = POLL_INITIAL_DELAY
+    while True:
+        if check():
+            return True
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return False
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+def getmaintenancemode_onbox():
+    # vim-cmd is a native binary, esxcli pays a Python/pyVmomi start up on every call of the poll.
+    # esxcli is only used if the host summary does not carry the field.
+    match = _MM_RE.search(sendcommand_onbox(list(_CMD_HOSTSUMMARY)))
+    if match:
+        return match.group(1) == "true"
+    resp = sendcommand_onbox(list(_CMD_MM_GET))
+    return resp.strip() == "Enabled"
 
 def maintenancemode_onbox(state):
+    # esxcli blocks until the host has finished the transition or --timeout runs out, so the
+    # state check below normally succeeds on its first try instead of polling in a loop.
+    # The set call and the check share one deadline, so the whole transition is held to the timeout.
+    deadline = monotonic() + MAINTENANCE_MODE_TIMEOUT
+    timeout = str(MAINTENANCE_MODE_TIMEOUT)
     if state:
-        print("Attempting to put host in MM. If it takes more than 45 seconds, I'm exiting program with an error.")
-        resp = os.popen("esxcli system maintenanceMode set --enable true").read()
+        print(f"Attempting to put host in MM. If it takes more than {timeout} seconds, "
+              "I'm exiting program with an error.")
+        resp = sendcommand_onbox([*_CMD_MM_SET, "--enable", "true", "--timeout", timeout])
         print(resp)
     else:
-        resp = os.popen("esxcli system maintenanceMode set --enable false").read()
+        resp = sendcommand_onbox([*_CMD_MM_SET, "--enable", "false", "--timeout", timeout])
     print(resp)
+    # Returns True once the host reports the requested state
+    return waituntil(lambda: getmaintenancemode_onbox() == state, deadline - monotonic())
 
 def reboothost_onbox():
     print("Attempting to reboot the host! Please wait!")
-    resp = os.popen("reboot now").read()
+    resp = sendcommand_onbox(["reboot", "now"])
     print(resp)
     return 0
 
+@_gated(_POWER_SEM)
 def poweron_onbox(vm):
-    resp = os.popen("vim-cmd vmsvc/power.on " + vm).read()
-    print("I've powered on VM " + vm)
+    resp = sendcommand_onbox([*_CMD_POWER_ON, vm])
+    print(f"I've powered on VM {vm}")
     print(resp)
 
+def setautostart_onbox(vm, sequence):
+    # vim-cmd has no call that updates several auto-start entries at once, so this runs once per VM.
+    # A dry run already prints the command with its DRY: prefix.
+    if not DRY_RUN:
+        print(f'vim-cmd hostsvc/autostartmanager/update_autostartentry {vm} "PowerOn" "15" '
+              f'"{sequence}" "systemDefault" "systemDefault" "systemDefault"')
+    return sendcommand_onbox([*_CMD_AUTOSTART_ENTRY, vm, "PowerOn", "15", str(sequence),
+                              "systemDefault", "systemDefault", "systemDefault"])
+
+def restorevms_onbox(vmids):
+    # Powers the given VMs back on in parallel, used when the upgrade is abandoned
+    if not vmids:
+        print("No VMs were powered off by this script, nothing to power back on.")
+        return
+    print(f"Powering VMs back on: {', '.join(sorted(vmids, key=int))}")
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(vmids))) as executor:
+        list(executor.map(poweron_onbox, vmids))
+
+def loadstate_onbox():
+    # Returns the VMs a recent STATE_FILE says were powered off, or None if there is no usable one.
+    # The saved power states are not reused, they may no longer match the host.
+    # A dry run neither reads nor writes the file, its canned inventory must not leak into a real run.
+    if DRY_RUN:
+        return None
+    try:
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+        if time() - state["ts"] < STATE_MAX_AGE:
+            return set(state["off"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def savestate_onbox(vms, powered_off_vms):
+    if DRY_RUN:
+        return
+    try:
+        with open(STATE_FILE, 'w') as f:
+            json.dump({"vms": vms, "off": sorted(powered_off_vms), "ts": time()}, f)
+    except OSError as e:
+        print(f"Could not save state to {STATE_FILE}: {e}")
+
+def removestate_onbox():
+    if not DRY_RUN and os.path.exists(STATE_FILE):
+        os.remove(STATE_FILE)
+
+def dryrunresponse(command):
+    # Prints the command instead of running it and returns output the parsers accept.
+    # The canned inventory has one powered on VM with VMware tools and one without, so a dry run
+    # walks through the auto-start, guest shutdown and power off steps.
+    print(f"DRY: {' '.join(command)}")
+    if tuple(command[:2]) == _CMD_GETALLVMS:
+        return ("Vmid   Name        File                             Guest OS      Version   Annotation\n"
+                "1      dry-tools   [datastore1] dry-tools/dry.vmx   otherGuest    vmx-19\n"
+                "2      dry-notools [datastore1] dry-notools/dry.vmx otherGuest    vmx-19\n")
+    if tuple(command[:2]) == _CMD_SUMMARY:
+        tools = "toolsOk" if command[2] == "1" else "toolsNotInstalled"
+        return f'powerState = "poweredOn",\ntoolsStatus = "{tools}",\n'
+    return ""
+
 def sendcommand_onbox(command):
-    resp = os.popen(command).read()
+    # command is an argv list, it is run directly without going through /bin/sh
+    if DRY_RUN:
+        return dryrunresponse(command)
+    resp = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
     return resp
 
 if __name__ == "__main__":
 
-    # Remove check for command line arguments as it makes the code less prone to human mistyping parameters
+    # Remove check for command line arguments as it makes the code less prone to human mistyping parameters.
+    # The one optional flag is --dry-run, which prints the commands of a run without executing them.
+    if DRY_RUN:
+        print("Dry run: commands are printed with a DRY: prefix and not executed.")
 
     # There should be no need to login to ESXi host since script is already on the host datastore
 
     # Script will find out what directory its in
-    remotepath = sendcommand_onbox('pwd')
-
-    # Output given back with nextline character, we are removing it here
-    remotepath = remotepath.rstrip()
-
-    # Adding quotation marks to the directory path since the full path can have spaces sometimes
-    remotepath = "'" + remotepath + "/'"
-    print('Current working directory: ' + remotepath)
+    remotepath = os.getcwd()
+    print(f'Current working directory: {remotepath}')
 
     # What is the name of the file being used for upgrade? Hard coded file name.
     file_name = 'VMware-ESXi-7.0U2c-18426014-depot.zip'
-    print('Searching for file: ' + file_name)
+    print(f'Searching for file: {file_name}')
 
-    # List out the contents of the directory and collect the results in a variable
-    directory_contents = sendcommand_onbox("ls -l " + remotepath)
+    # set file path to be used for upgrade
+    # The path is passed as its own argv entry later on, so spaces in the datastore path need no quoting.
+    full_path = os.path.join(remotepath, file_name)
 
     # Check if the upgrade file is on the host datastore and in the correct directory. If not, exit script.
-    if file_name in directory_contents:
-        print('Found file ' + file_name + ' in directory ' + remotepath)
+    # A single stat of the depot path, a directory listing could also match other files mentioning the name.
+    if os.path.isfile(full_path):
+        print(f'Found file {file_name} in directory {remotepath}')
         print('proceeding with host upgrade.')
+    elif DRY_RUN:
+        print(f'Did not find file {file_name} in directory {remotepath}, continuing the dry run anyway.')
     else:
-        print('Did not find file ' + file_name + ' in directory ' + remotepath)
+        print(f'Did not find file {file_name} in directory {remotepath}')
         print('Cancelling the host upgrade.')
-        exit(0)
+        sys.exit(1)
 
-    # Removing the quotation marks from this string that were previously added so this string can be concatenated
-    remotepath = remotepath.rstrip("'")
-    remotepath = remotepath.strip("'")
+    remotepath = full_path
+    print(f"Full path for upgrade file is: {remotepath}")
 
-    # set file path to be used for upgrade
-    remotepath = remotepath + file_name
-    print("Full path for upgrade file is: " + remotepath)
+    # VMs an earlier, interrupted run powered off and did not get to power back on
+    previous_off = loadstate_onbox()
 
-    # make sure we enable SSH to turn on with the host reboot
-    sendcommand_onbox('vim-cmd hostsvc/enable_ssh')
+    # The host setup commands and the VM listing do not depend on each other, so they run side by side
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        # make sure we enable SSH to turn on with the host reboot
+        enable_ssh = executor.submit(sendcommand_onbox, ["vim-cmd", "hostsvc/enable_ssh"])
 
-    # enable VM auto start feature
-    sendcommand_onbox('vim-cmd hostsvc/autostartmanager/enable_autostart 1')
+        # enable VM auto start feature
+        enable_autostart = executor.submit(sendcommand_onbox,
+                                           ["vim-cmd", "hostsvc/autostartmanager/enable_autostart", "1"])
 
-    print("Getting list of VMs!")
-    vms = getvms_onbox()
+        print("Getting list of VMs!")
+        getallvms = executor.submit(sendcommand_onbox, list(_CMD_GETALLVMS))
+
+    # result() re-raises anything the commands hit, the same as calling them one after another did
+    enable_ssh.result()
+    enable_autostart.result()
+    vms = getvms_onbox(getallvms.result())
+
+    # powered_off_vms holds the VMs shut down or powered off by this script, the only ones brought back
+    # up if the upgrade is abandoned. Of an interrupted run's VMs, only those still off are taken over.
+    powered_off_vms = set()
+    if previous_off and vms != '':
+        powered_off_vms = {vm for vm in previous_off if vm in vms and vms[vm]["power"] == "poweredOff"}
+        if powered_off_vms:
+            print(f"VMs powered off by an earlier run, will be powered back on if the upgrade is abandoned: "
+                  f"{', '.join(sorted(powered_off_vms, key=int))}")
+    savestate_onbox(vms, powered_off_vms)
 
     print("Completed getting list of VMs!")
-    sleep(1)
 
-    # Getting the powerstate of the VMs and putting it into dictionary
-    powerstate = {}
+    # The VM list already carries the power state of every VM
     if vms == '':
         print("There are no VMs on this host. Skipping to the next step of the upgrade.")
     else:
         for i in vms:
-            powerstate[vms[i]] = getvmpowerstate_onbox(vms[i])
-        for i in powerstate:
-            print(powerstate[i] + "\n")
+            print(f"{vms[i]['power']}\n")
 
         print("Dumping powerstate table just in case something goes wrong later....")
-        pprint(powerstate)
-
-    sleep(1)
+        pprint(vms)
 
     # Configure VMs for auto power on and power off the VMs
     if vms == '':
         print('There are no VMs on this host, skipping VM power down.')
     else:
         print("")
-        # I've created this variable as a substitute for index variable in the for loop.
-        # index variable in the for loop is thrown off by ESXi hosts with powered off VMs
-        auto_vm_power_on_sequence = 1
-        # powerstate dict must use separate index+1 or iteration will not be in ascending order.
-        for index, i in enumerate(powerstate.keys()):
-            if powerstate[i] == "poweredOn":
-                # Configure VM for auto-start
-                print('vim-cmd hostsvc/autostartmanager/update_autostartentry ' + vms[i] + ' "PowerOn" "15" "'
-                      + str(auto_vm_power_on_sequence) + '" "systemDefault" "systemDefault" "systemDefault"')
-                sendcommand_onbox('vim-cmd hostsvc/autostartmanager/update_autostartentry ' + vms[i] +
-                                  ' "PowerOn" "15" "' + str(auto_vm_power_on_sequence) +
-                                  '" "systemDefault" "systemDefault" "systemDefault"')
-
-                # Powering off the VM, skipping shutdown since the script runs on esxi and severs user connection
-                print("Shutting down ID: " + i + "\n")
-                shutdown_response = poweroffvm_onbox(i)
-                auto_vm_power_on_sequence += 1
-                print(shutdown_response)
-
-    sleep(1)
+        # vms dict keeps the getallvms order, so the start order follows the ascending vmids.
+        # The entries are written one at a time: hostd can shift the startOrder of other entries
+        # when a position is already taken, so only a serial write gives a predictable order.
+        poweroff_list = [i for i in vms if vms[i]["power"] == "poweredOn"]
+        for sequence, i in enumerate(poweroff_list, start=1):
+            setautostart_onbox(i, sequence)
+
+        if poweroff_list:
+            # Guest shutdown needs running VMware tools, the other VMs go straight to power off
+            shutdown_list = [i for i in poweroff_list if vms[i]["tools"] in ("toolsOk", "toolsOld")]
+            hard_poweroff_list = [i for i in poweroff_list if i not in shutdown_list]
+
+            if shutdown_list:
+                # Send every shutdown first, then wait for all of them against a single deadline
+                print(f"Shutting down IDs: {', '.join(shutdown_list)}\n")
+                with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(shutdown_list))) as executor:
+                    for shutdown_response in executor.map(sendshutdown_onbox, shutdown_list):
+                        print(shutdown_response)
+
+                    deadline = monotonic() + SHUTDOWN_TIMEOUT
+                    poweredoff = list(executor.map(lambda vm: waitpoweredoff_onbox(vm, deadline), shutdown_list))
+                hard_poweroff_list += [vm for vm, done in zip(shutdown_list, poweredoff) if not done]
+                powered_off_vms.update(vm for vm, done in zip(shutdown_list, poweredoff) if done)
+
+            if hard_poweroff_list:
+                print(f"Powering off IDs: {', '.join(hard_poweroff_list)}\n")
+                with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(hard_poweroff_list))) as executor:
+                    for shutdown_response in executor.map(poweroffvm_onbox, hard_poweroff_list):
+                        print(shutdown_response)
+                powered_off_vms.update(hard_poweroff_list)
+
+        savestate_onbox(vms, powered_off_vms)
 
     print("Trying to put the host in MM.")
-    maintenancemode_onbox(True)
+    if not maintenancemode_onbox(True):
+        print(f"Host did not enter MM within {MAINTENANCE_MODE_TIMEOUT} seconds. Exiting.")
+        maintenancemode_onbox(False)
+        restorevms_onbox(powered_off_vms)
+        removestate_onbox()
+        sys.exit(1)
     print("Host in MM successful.")
-    sleep(1)
 
     print("Upgrading host. After upgrade, will bring host out of MM and reboot the host!")
-    upgradehost_onbox(remotepath)
+    if not upgradehost_onbox(remotepath):
+        print("Upgrade failed. Bringing host out of MM without rebooting.")
+        maintenancemode_onbox(False)
+        restorevms_onbox(powered_off_vms)
+        removestate_onbox()
+        sys.exit(1)
 
     # Bringing host out of MM:
     print("Upgrade complete. Bringing host out of MM.")
-    maintenancemode_onbox(False)
+    if not maintenancemode_onbox(False):
+        print(f"Host did not leave MM within {MAINTENANCE_MODE_TIMEOUT} seconds, rebooting anyway.")
+
+    # The saved state only matters while VMs are down, drop it once the upgrade went through
+    removestate_onbox()
 
     # Rebooting the host and disconnecting the SSH session.
     print("Rebooting Host")